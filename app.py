@@ -3,6 +3,12 @@ import sqlite3
 import pandas as pd
 import plotly.express as px
 import os
+import csv
+import io
+import functools
+import contextlib
+import time
+import urllib.request
 
 # Page config
 st.set_page_config(
@@ -11,15 +17,10 @@ st.set_page_config(
     layout="wide"
 )
 
-# Branding CSS
+# Branding colors live in .streamlit/config.toml. What the theme can't express
+# stays here; it must be emitted on every run, or Streamlit drops it as stale.
 st.markdown(
-    """
-    <style>
-    .reportview-container, .main { background-color: #f8f9fa; }
-    .sidebar .sidebar-content { background-image: linear-gradient(180deg, #004990 0%, #61be64 100%); color: white; }
-    .stButton>button { background-color: #61be64; color: white; border-radius: .25em; }
-    #MainMenu, footer { visibility: hidden; }
-    """,
+    "<style>.stButton>button { background-color: #61be64; color: white; } footer { visibility: hidden; }</style>",
     unsafe_allow_html=True
 )
 
@@ -27,28 +28,321 @@ st.markdown(
 DB_PATH = st.sidebar.text_input("Caminho para o SQLite DB", value="cnpj.db")
 
 # DB helpers
-def get_conn():
-    return sqlite3.connect(DB_PATH, check_same_thread=False)
+@st.cache_resource
+def get_conn(db_path):
+    # One shared connection per DB file; never close it
+    conn = sqlite3.connect(db_path, check_same_thread=False, isolation_level=None)
+    try:
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+    except sqlite3.OperationalError:
+        # Read-only file or directory: keep the current journal mode, reads still work
+        pass
+    conn.execute("PRAGMA temp_store=MEMORY")
+    conn.execute("PRAGMA mmap_size=268435456")
+    conn.execute("PRAGMA cache_size=-65536")
+    return conn
+
+def db_mtime():
+    # Part of every metadata cache key, so uploads invalidate cached results.
+    # With WAL, writes land in the -wal file before the main DB is touched.
+    mtimes = [0.0]
+    for path in (DB_PATH, DB_PATH + "-wal"):
+        try:
+            mtimes.append(os.path.getmtime(path))
+        except OSError:
+            pass
+    return max(mtimes)
+
+def quote_ident(name):
+    # Table/column names come from uploaded file names and CSV headers
+    return '"' + name.replace('"', '""') + '"'
+
+def canonical_cols(selected, allowed):
+    # Known columns only, in schema order: picking the same columns in any order
+    # gives the same SQL text, so cached results and prepared statements are reused
+    chosen = set(selected)
+    return [c for c in allowed if c in chosen]
+
+def fetch_list(db_path, sql, params=()):
+    # First column of a small result as a plain list; no DataFrame overhead
+    return [r[0] for r in get_conn(db_path).execute(sql, params).fetchall()]
+
+# User SQL runs on its own read-only connection with a time budget, so a
+# stray UPDATE or a runaway cross join can't lock or stall the shared DB
+QUERY_TIMEOUT = 10
+EXPORT_TIMEOUT = 120
 
-def available_tables():
+def sandbox_conn(db_path, timeout):
+    uri = f"file:{urllib.request.pathname2url(os.path.abspath(db_path))}?mode=ro"
+    conn = sqlite3.connect(uri, uri=True, check_same_thread=False)
+    conn.execute("PRAGMA query_only=ON")
+    deadline = time.monotonic() + timeout
+    # Non-zero return aborts the statement with OperationalError('interrupted')
+    conn.set_progress_handler(lambda: time.monotonic() > deadline, 100_000)
+    return conn
+
+@contextlib.contextmanager
+def open_cursor(db_path, sql, params=(), timeout=None):
+    # timeout=None: SQL built by the app, on the shared connection
+    conn = get_conn(db_path) if timeout is None else sandbox_conn(db_path, timeout)
+    try:
+        cur = conn.execute(sql, params)
+        try:
+            yield cur
+        finally:
+            cur.close()
+    finally:
+        if timeout is not None:
+            conn.close()
+
+@st.cache_data(ttl=300, show_spinner=False)
+def available_tables(db_path, mtime):
     try:
-        with get_conn() as conn:
-            return [r[0] for r in conn.execute("SELECT name FROM sqlite_master WHERE type='table';")]
+        return fetch_list(db_path, "SELECT name FROM sqlite_master WHERE type='table' AND name NOT LIKE 'sqlite_%';")
     except:
         return []
 
-def get_df(table, query=None, params=()):
-    with get_conn() as conn:
-        if query:
-            return pd.read_sql_query(query, conn, params=params)
-        return pd.read_sql_query(f"SELECT * FROM {table};", conn)
+@st.cache_data(ttl=300, show_spinner=False)
+def schema(db_path, mtime):
+    # Declared column types of every table in one query, e.g.
+    # {'Importacao': {'VL_FOB': 'REAL', 'SG_UF': 'TEXT'}}
+    tables = {}
+    for table, col, decl in get_conn(db_path).execute(
+            "SELECT m.name, p.name, upper(coalesce(p.type, '')) FROM sqlite_master m "
+            "JOIN pragma_table_info(m.name) p WHERE m.type = 'table' AND m.name NOT LIKE 'sqlite_%' "
+            "ORDER BY m.rowid, p.cid;"):
+        tables.setdefault(table, {})[col] = decl
+    return tables
+
+def col_types(db_path, table, mtime):
+    return schema(db_path, mtime).get(table, {})
+
+def cols_for(db_path, table, mtime):
+    return list(col_types(db_path, table, mtime))
+
+def is_numeric_type(decl):
+    # SQLite affinity rules: INT*, REAL/FLOA*/DOUB*, NUMERIC/DECIMAL
+    return any(k in decl for k in ('INT', 'REAL', 'FLOA', 'DOUB', 'NUM', 'DEC'))
+
+def is_text_type(decl):
+    return any(k in decl for k in ('CHAR', 'CLOB', 'TEXT'))
+
+@st.cache_data(ttl=300, show_spinner=False)
+def numeric_cols(db_path, table, mtime):
+    types = col_types(db_path, table, mtime)
+    numeric = {c for c, t in types.items() if is_numeric_type(t)}
+    untyped = [c for c, t in types.items() if not t]
+    if untyped:
+        # Columns without a declared type (e.g. CREATE TABLE AS SELECT SUM(...)):
+        # check the storage class of a single row instead of scanning the table
+        exprs = ", ".join(f"typeof({quote_ident(c)})" for c in untyped)
+        row = get_conn(db_path).execute(f"SELECT {exprs} FROM {quote_ident(table)} LIMIT 1;").fetchone() or ()
+        numeric.update(c for c, t in zip(untyped, row) if t in ('integer', 'real'))
+    return [c for c in types if c in numeric]
+
+@st.cache_data(max_entries=64, ttl=600)
+def run_query(db_path, sql, params=(), mtime=0.0):
+    return pd.read_sql_query(sql, get_conn(db_path), params=params)
+
+@st.cache_data(max_entries=64, ttl=600)
+def preview_query(db_path, sql, limit, params=(), mtime=0.0, timeout=None):
+    # SQLite produces rows lazily, so fetching only `limit` rows stops the
+    # statement early instead of materializing the whole result
+    with open_cursor(db_path, sql, params, timeout) as cur:
+        rows = cur.fetchmany(limit)
+        cols = [d[0] for d in cur.description] if cur.description else []
+    return pd.DataFrame.from_records(rows, columns=cols)
+
+@st.cache_data(max_entries=4, ttl=600, show_spinner=False)
+def query_csv(db_path, sql, params=(), mtime=0.0, batch=10_000, timeout=None):
+    # CSV straight from the cursor in batches: no DataFrame, no intermediate str
+    buf = io.BytesIO()
+    text = io.TextIOWrapper(buf, encoding='utf-8', newline='')
+    with open_cursor(db_path, sql, params, timeout) as cur:
+        writer = csv.writer(text, lineterminator='\n')
+        writer.writerow(d[0] for d in cur.description)
+        while rows := cur.fetchmany(batch):
+            writer.writerows(rows)
+    text.flush()
+    text.detach()
+    return buf.getvalue()
+
+def glob_prefix(value):
+    # Case-sensitive prefix pattern; unlike LIKE, GLOB can use a plain index
+    return ''.join(f'[{c}]' if c in '*?[' else c for c in value) + '*'
+
+# Summary charts don't need hover/zoom; a static plot skips Plotly.js event wiring
+STATIC_CFG = dict(staticPlot=True, displayModeBar=False)
+
+# Chart helpers: rebuilding a px figure costs far more than unpickling a cached one.
+# They take the query rather than its DataFrame, so the cache key is a short
+# string instead of a hash over every cell of the frame.
+def long_form(db_path, sql, mtime, x, metrics):
+    # Melt to one row per (x, metric); the names are prefixed until they can't
+    # clash with a real column (Brazilian tables often have a 'valor' column)
+    var, val = 'metrica', 'valor'
+    while var in metrics + (x,):
+        var = '_' + var
+    while val in metrics + (x,):
+        val = '_' + val
+    df = run_query(db_path, sql, mtime=mtime).melt(id_vars=x, value_vars=list(metrics), var_name=var, value_name=val)
+    return df, var, val
+
+def facet_spacing(n):
+    # Plotly rejects row spacing above 1 / (rows - 1), which the default hits at 16 rows
+    rows = (n + 1) // 2
+    return min(0.07, 0.5 / max(1, rows - 1))
+
+def facet(fig, n):
+    # One panel per metric, each with its own y scale, labelled by metric name
+    fig.update_yaxes(matches=None, showticklabels=True)
+    fig.for_each_annotation(lambda a: a.update(text=a.text.split('=')[-1]))
+    fig.update_layout(height=350 * ((n + 1) // 2))
+    return fig
+
+@st.cache_data(max_entries=64, show_spinner=False)
+def make_bar(db_path, sql, mtime, x, metrics, title):
+    df, var, val = long_form(db_path, sql, mtime, x, metrics)
+    fig = px.bar(df, x=x, y=val, facet_col=var, facet_col_wrap=2, facet_row_spacing=facet_spacing(len(metrics)),
+                 labels={val: 'valor'}, title=title)
+    return facet(fig, len(metrics))
+
+@st.cache_data(max_entries=64, show_spinner=False)
+def make_line(db_path, sql, mtime, x, metrics, title):
+    df, var, val = long_form(db_path, sql, mtime, x, metrics)
+    # WebGL traces: a daily DATA axis can hold thousands of points per panel
+    fig = px.line(df, x=x, y=val, facet_col=var, facet_col_wrap=2, facet_row_spacing=facet_spacing(len(metrics)),
+                  labels={val: 'valor'}, title=title, render_mode='webgl')
+    return facet(fig, len(metrics))
+
+# Upload helpers
+SQLITE_MAX_VARS = 999
+
+def write_conn(db_path):
+    # Uploads bypass the shared autocommit connection: with Python's implicit
+    # transactions each to_sql call commits once instead of once per row.
+    # Under WAL, NORMAL skips the fsync on every commit and stays corruption-safe.
+    conn = sqlite3.connect(db_path)
+    conn.execute("PRAGMA synchronous=NORMAL")
+    return conn
+
+def insert_chunksize(df):
+    # Rows per multi-row INSERT, kept under SQLite's bound-variable limit
+    return max(1, SQLITE_MAX_VARS // max(1, len(df.columns)))
+
+# Columns the pages filter and group on
+INDEXED_COLS = ('ANO_MES', 'CO_ANO', 'SG_UF', 'UF_IMPORTADOR', 'MES', 'CO_MES',
+                'PROVAVEL_IMPORTADOR_CNPJ', 'cnpj_basico')
+# Year/state/month filters on the Comex import table
+COMPOSITE_INDEXES = (('CO_ANO', 'SG_UF', 'CO_MES'),)
+
+def create_indexes(conn, name):
+    # Returns how many indexes were actually new
+    cols = [r[0] for r in conn.execute("SELECT name FROM pragma_table_info(?);", (name,))]
+    existing = {r[0] for r in conn.execute("SELECT name FROM sqlite_master WHERE type='index' AND tbl_name=?;", (name,))}
+    created = 0
+    for combo in [(c,) for c in INDEXED_COLS] + list(COMPOSITE_INDEXES):
+        idx = f"idx_{name}_{'_'.join(combo)}"
+        if idx not in existing and all(c in cols for c in combo):
+            conn.execute(f"CREATE INDEX {quote_ident(idx)} ON {quote_ident(name)}({', '.join(map(quote_ident, combo))})")
+            created += 1
+    return created
+
+# Pre-aggregated copies of fact tables: {rollup: (source, group keys, summed columns)}.
+# A few thousand rows the metrics page can chart without scanning every declaration.
+ROLLUPS = {
+    'imp_monthly_uf': ('Importacao', ('CO_ANO', 'CO_MES', 'SG_UF'), ('VL_FOB', 'KG_LIQUIDO', 'QT_ESTAT')),
+}
+
+def create_rollups(conn, name, replace=True):
+    # replace=False only builds missing rollups; returns how many were (re)built
+    cols = [r[0] for r in conn.execute("SELECT name FROM pragma_table_info(?);", (name,))]
+    existing = {r[0] for r in conn.execute("SELECT name FROM sqlite_master WHERE type='table';")}
+    built = 0
+    for rollup, (source, keys, sums) in ROLLUPS.items():
+        if source != name or not all(c in cols for c in keys + sums):
+            continue
+        if rollup in existing and not replace:
+            continue
+        k = ", ".join(map(quote_ident, keys))
+        s = ", ".join(f"SUM({quote_ident(c)}) AS {quote_ident(c)}" for c in sums)
+        conn.execute(f"DROP TABLE IF EXISTS {quote_ident(rollup)}")
+        conn.execute(f"CREATE TABLE {quote_ident(rollup)} AS SELECT {k}, {s} FROM {quote_ident(name)} GROUP BY {k}")
+        create_indexes(conn, rollup)
+        built += 1
+    return built
+
+@st.cache_resource(show_spinner="Criando índices...")
+def ensure_indexes(db_path):
+    # Databases built outside the uploader get the same indexes and rollups, once per process
+    conn = write_conn(db_path)
+    try:
+        tables = [r[0] for r in conn.execute("SELECT name FROM sqlite_master WHERE type='table' AND name NOT LIKE 'sqlite_%';")]
+        changed = sum(create_indexes(conn, t) for t in tables)
+        changed += sum(create_rollups(conn, t, replace=False) for t in tables)
+        if changed:
+            conn.execute("ANALYZE")
+        conn.commit()
+    except sqlite3.Error:
+        # Read-only or locked file: the app still works, just without new indexes
+        conn.rollback()
+    finally:
+        conn.close()
+    return True
+
+# Known Comex/CNPJ columns: skip dtype inference and keep CNPJ leading zeros.
+# Integers stay Int64: narrower pandas ints wrap out-of-range values (e.g. a
+# YYYYMM MES) without raising, and SQLite stores every integer the same way.
+SCHEMA_HINTS = {
+    'VL_FOB': 'float64', 'KG_LIQUIDO': 'float64', 'QT_ESTAT': 'float64',
+    'CO_ANO': 'Int64', 'CO_MES': 'Int64', 'MES': 'Int64', 'ANO_MES': 'Int64',
+    'SG_UF': 'category', 'cnpj_basico': 'string', 'PROVAVEL_IMPORTADOR_CNPJ': 'string',
+}
+
+def sniff_csv(f, sample_size=65536):
+    # Detect the delimiter and header from the head of the file instead of decoding all of it
+    sample = f.read(sample_size).decode('utf-8-sig', errors='ignore')
+    f.seek(0)
+    try:
+        sep = csv.Sniffer().sniff(sample, delimiters=',;\t|').delimiter
+    except csv.Error:
+        sep = ','
+    header = next(csv.reader(sample.splitlines()[:1], delimiter=sep), [])
+    return sep, header
+
+def insert_csv(f, name, conn, sep, dtype, chunksize):
+    # Stream the file into SQLite chunk by chunk to keep peak memory bounded
+    rows = 0
+    reader = pd.read_csv(f, sep=sep, dtype=dtype, engine='c', on_bad_lines='skip', chunksize=chunksize)
+    for i, chunk in enumerate(reader):
+        chunk.to_sql(name, conn, if_exists='append' if i else 'replace', index=False,
+                     method='multi', chunksize=insert_chunksize(chunk))
+        rows += len(chunk)
+    return rows
+
+def load_csv(f, name, conn, chunksize=50_000):
+    sep, header = sniff_csv(f)
+    hints = {c: SCHEMA_HINTS[c] for c in header if c in SCHEMA_HINTS}
+    try:
+        return insert_csv(f, name, conn, sep, hints, chunksize)
+    except (ValueError, TypeError):
+        if not hints:
+            raise
+        # A hinted column held something else (e.g. '1.234,56'); reload with
+        # inference. The first chunk replaces the table, so partial rows go away.
+        conn.rollback()
+        f.seek(0)
+        return insert_csv(f, name, conn, sep, None, chunksize)
 
 # Main application
 def main():
     st.title("📊 Indovinya Comex Dashboard")
     menu = ["Visão Geral", "Métricas Dinâmicas", "Consulta", "Exportar"]
     choice = st.sidebar.radio("Menu", menu)
-    tables = available_tables()
+    tables = available_tables(DB_PATH, db_mtime())
+    if tables:
+        ensure_indexes(DB_PATH)
 
     if choice != "Visão Geral" and not tables:
         st.error("Nenhuma tabela carregada. Vá em Visão Geral para importar dados.")
@@ -72,23 +366,31 @@ def overview(tables):
         st.write(f"Tabelas ({len(tables)}): {tables}")
         for t in tables:
             with st.expander(t):
-                cols = [r[1] for r in get_conn().execute(f"PRAGMA table_info({t});")]
-                st.write(cols)
+                st.write(cols_for(DB_PATH, t, db_mtime()))
     else:
         st.info("Nenhuma tabela. Envie CSV/JSON/HTML abaixo:")
         uploaded = st.file_uploader("Arquivos (.csv .json .html)", type=['csv','json','html'], accept_multiple_files=True)
         if uploaded:
-            conn = get_conn()
+            conn = write_conn(DB_PATH)
             for f in uploaded:
                 name, ext = os.path.splitext(f.name)
                 try:
-                    if ext == '.csv': df = pd.read_csv(f, engine='python', on_bad_lines='skip')
-                    elif ext == '.json': df = pd.read_json(f, orient='records')
-                    else: df = pd.read_html(f)[0]
-                    df.to_sql(name, conn, if_exists='replace', index=False)
-                    st.write(f"Tabela '{name}' carregada ({len(df)} linhas)")
+                    if ext == '.csv':
+                        rows = load_csv(f, name, conn)
+                    else:
+                        if ext == '.json': df = pd.read_json(f, orient='records')
+                        else: df = pd.read_html(f)[0]
+                        df.to_sql(name, conn, if_exists='replace', index=False,
+                                  method='multi', chunksize=insert_chunksize(df))
+                        rows = len(df)
+                    create_indexes(conn, name)
+                    create_rollups(conn, name)
+                    st.write(f"Tabela '{name}' carregada ({rows} linhas)")
                 except Exception as e:
+                    conn.rollback()
                     st.error(f"Erro em {f.name}: {e}")
+            conn.execute("ANALYZE")
+            conn.commit()
             conn.close()
             st.success("Dados importados. Recarregue para visualizar.")
 
@@ -97,44 +399,84 @@ def overview(tables):
 def dynamic_metrics(tables):
     st.header("📈 Métricas Dinâmicas")
     table = st.selectbox("Selecione a tabela", tables)
-    if not table:
-        return
-    df = get_df(table)
-    # Select numeric columns
-    numeric = [c for c in df.columns if pd.api.types.is_numeric_dtype(df[c])]
-    cols = st.multiselect("Selecione métricas", numeric, default=numeric[:3])
-    if cols:
+    if table:
+        metrics_panel(table)
+
+@st.fragment
+def metrics_panel(table):
+    # Submitting the form reruns only this panel, not main() and the sidebar
+    types = col_types(DB_PATH, table, db_mtime())
+    # Select numeric columns from the declared schema, no data read needed
+    numeric = numeric_cols(DB_PATH, table, db_mtime())
+    time_cols = [c for c in types if 'MES' in c or 'MONTH' in c or 'DATA' in c.upper()]
+    # Queries only run on submit, not on every widget change
+    with st.form("metricas"):
+        cols = st.multiselect("Selecione métricas", numeric, default=numeric[:3])
         # Group by selection dimension
-        dim = st.selectbox("Agrupar por", [None] + [c for c in df.columns if df[c].dtype == object])
-        if st.button("Atualizar gráficos"):
-            if dim:
-                for metric in cols:
-                    grouped = df.groupby(dim)[metric].sum().reset_index()
-                    fig = px.bar(grouped, x=dim, y=metric, title=f"{metric} por {dim}")
-                    st.plotly_chart(fig, use_container_width=True)
+        dim = st.selectbox("Agrupar por", [None] + [c for c, t in types.items() if is_text_type(t)])
+        # Time series if exists a date or month column
+        time = st.selectbox("Eixo tempo (opcional)", [None] + time_cols)
+        submitted = st.form_submit_button("Atualizar gráficos")
+    cols = canonical_cols(cols, numeric)
+    if submitted and not cols:
+        st.info("Selecione ao menos uma métrica.")
+    elif submitted:
+        if dim:
+            if time:
+                st.info(f"Agrupando por {dim}; o eixo tempo é ignorado quando há agrupamento.")
+            sums = ", ".join(f"SUM({quote_ident(m)}) AS {quote_ident(m)}" for m in cols)
+            sql = f"SELECT {quote_ident(dim)}, {sums} FROM {quote_ident(table)} GROUP BY {quote_ident(dim)};"
+            # One faceted figure for all metrics instead of one figure each
+            fig = make_bar(DB_PATH, sql, db_mtime(), dim, tuple(cols), f"Métricas por {dim}")
+            st.plotly_chart(fig, width='stretch', config=STATIC_CFG)
+        elif not time_cols:
+            st.info("Não há coluna temporal para séries.")
+        elif not time:
+            st.info("Escolha 'Agrupar por' ou 'Eixo tempo' para gerar os gráficos.")
+        else:
+            metrics = [m for m in cols if m != time]
+            if not metrics:
+                st.info(f"Selecione métricas além de {time}.")
             else:
-                # Time series if exists a date or month column
-                time_cols = [c for c in df.columns if 'MES' in c or 'MONTH' in c or 'DATA' in c.upper()]
-                if time_cols:
-                    time = st.selectbox("Eixo tempo (opcional)", [None] + time_cols)
-                    if time:
-                        for metric in cols:
-                            ts = df.groupby(time)[metric].sum().reset_index()
-                            fig = px.line(ts, x=time, y=metric, title=f"{metric} ao longo de {time}")
-                            st.plotly_chart(fig, use_container_width=True)
-                else:
-                    st.info("Não há coluna temporal para séries.")
+                sums = ", ".join(f"SUM({quote_ident(m)}) AS {quote_ident(m)}" for m in metrics)
+                t = quote_ident(time)
+                sql = f"SELECT {t}, {sums} FROM {quote_ident(table)} GROUP BY {t} ORDER BY {t};"
+                fig = make_line(DB_PATH, sql, db_mtime(), time, tuple(metrics), f"Métricas ao longo de {time}")
+                st.plotly_chart(fig, width='stretch', config=STATIC_CFG)
 
 # 3. Consulta SQL
 
 def custom_query():
     st.header("🔧 Consulta Personalizada")
     q = st.text_area("Digite SQL:")
-    if st.button("Executar") and q.strip():
-        try:
-            df = execute_query(q)
-            st.dataframe(df)
-        except Exception as e:
+    row_limit = st.number_input("Linhas na prévia", min_value=1, value=1000, step=1000)
+    c1, c2 = st.columns(2)
+    run = c1.button("Executar")
+    explain = c2.button("Plano de execução")
+    if not (run or explain) or not q.strip():
+        return
+    try:
+        if explain:
+            # SCAN vs SEARCH ... USING INDEX shows whether a filter hits an index
+            st.dataframe(preview_query(DB_PATH, "EXPLAIN QUERY PLAN " + q, 1000, (), db_mtime(), QUERY_TIMEOUT),
+                         width='stretch')
+            return
+        df = preview_query(DB_PATH, q, int(row_limit), (), db_mtime(), QUERY_TIMEOUT)
+        if len(df) == row_limit:
+            st.info(f"Mostrando as primeiras {len(df)} linhas.")
+        st.dataframe(df, height=400, width='stretch')
+        # Full result only on click, streamed like the export page; no rerun on
+        # click, which would drop this branch of the page
+        st.download_button("Exportar resultado completo",
+                           functools.partial(query_csv, DB_PATH, q, (), db_mtime(), timeout=EXPORT_TIMEOUT),
+                           file_name="consulta.csv", mime='text/csv', on_click='ignore')
+    except Exception as e:
+        if str(e) == 'interrupted':
+            st.error(f"Consulta cancelada após {QUERY_TIMEOUT} s.")
+        elif 'readonly database' in str(e):
+            # Raised by the read-only sandbox for any write, DDL or write pragma
+            st.error("Somente consultas de leitura são permitidas.")
+        else:
             st.error(f"Erro na consulta: {e}")
 
 # 4. Exportar
@@ -143,8 +485,28 @@ def export_data(tables):
     st.header("📤 Exportar Dados")
     tbl = st.selectbox("Tabela", tables)
     if tbl:
-        df = get_df(tbl)
-        st.download_button("Download CSV", df.to_csv(index=False), file_name=f"{tbl}.csv")
+        export_panel(tbl)
+
+@st.fragment
+def export_panel(tbl):
+    # Column/filter/preview changes rerun only this panel, not main() and the sidebar
+    all_cols = cols_for(DB_PATH, tbl, db_mtime())
+    sel = st.multiselect("Colunas", all_cols, default=all_cols)
+    col = st.selectbox("Filtrar coluna (opcional)", [None] + all_cols)
+    val = st.text_input("Começa com") if col else ""
+    sel = canonical_cols(sel, all_cols)
+    if not sel:
+        return
+    sql = f"SELECT {', '.join(map(quote_ident, sel))} FROM {quote_ident(tbl)}"
+    params = ()
+    if val:
+        sql += f" WHERE {quote_ident(col)} GLOB ?"
+        params = (glob_prefix(val),)
+    row_limit = st.number_input("Linhas na prévia", min_value=1, value=1000, step=1000)
+    st.dataframe(preview_query(DB_PATH, sql, int(row_limit), params, db_mtime()), height=400, width='stretch')
+    # Deferred: the CSV is only built when the button is clicked, not on every rerun
+    st.download_button("Download CSV", functools.partial(query_csv, DB_PATH, sql, params, db_mtime()),
+                       file_name=f"{tbl}.csv", mime='text/csv')
 
 if __name__ == '__main__':
     main()